@@ -20,6 +20,11 @@ register(
     entry_point='gym_reinmav.envs.native:Quadrotor3D',
 )
 
+register(
+    id='quadrotor3d-batch-v0',
+    entry_point='gym_reinmav.envs.native:Quadrotor3DBatch',
+)
+
 register(
     id='quadrotor3d-slungload-v0',
     entry_point='gym_reinmav.envs.native:Quadrotor3DSlungload',
@@ -2,4 +2,5 @@ from gym_reinmav.envs.native.reinmav_env import ReinmavEnv
 from gym_reinmav.envs.native.quadrotor2d import Quadrotor2D
 from gym_reinmav.envs.native.quadrotor2d_slungload import Quadrotor2DSlungload
 from gym_reinmav.envs.native.quadrotor3d import Quadrotor3D
+from gym_reinmav.envs.native.quadrotor3d_batch import Quadrotor3DBatch
 from gym_reinmav.envs.native.quadrotor3d_slungload import Quadrotor3DSlungload
@@ -33,27 +33,146 @@
 # *************************************************************************
 import gym
 from gym import error, spaces, utils, logger
-from math import cos, sin, pi, atan2
+from math import cos, sin, pi, atan2, sqrt, copysign
 import numpy as np
 from numpy import linalg
 from gym.utils import seeding
-from pyquaternion import Quaternion
+from timeit import default_timer as timer
+from numba import njit
+
+_STEP_AFTER_DONE_MSG = "You are calling 'step()' even though this environment has already returned done = True. You should always call 'reset()' once you receive 'done = True' -- any further steps are undefined behavior."
+
+# Quaternion primitives on (w, x, y, z) tuples or arrays
+
+@njit(cache=True)
+def _qmul(a, b):
+	# Hamilton product a x b
+	return (a[0]*b[0] - a[1]*b[1] - a[2]*b[2] - a[3]*b[3],
+			a[0]*b[1] + a[1]*b[0] + a[2]*b[3] - a[3]*b[2],
+			a[0]*b[2] - a[1]*b[3] + a[2]*b[0] + a[3]*b[1],
+			a[0]*b[3] + a[1]*b[2] - a[2]*b[1] + a[3]*b[0])
+
+@njit(cache=True)
+def _qdot(q, w):
+	# Quaternion kinematics: q_dot = 0.5 * q x (0, w)
+	return (-0.5*(q[1]*w[0] + q[2]*w[1] + q[3]*w[2]),
+			0.5*(q[0]*w[0] + q[2]*w[2] - q[3]*w[1]),
+			0.5*(q[0]*w[1] - q[1]*w[2] + q[3]*w[0]),
+			0.5*(q[0]*w[2] + q[1]*w[1] - q[2]*w[0]))
+
+@njit(cache=True)
+def _acc2quat(acc_x, acc_y, acc_z): # TODO: Yaw rotation
+	# Desired attitude that points the body z-axis along the desired
+	# acceleration. With yc = [0, 1, 0] the desired frame is a pitch about y
+	# followed by a roll about x, so the quaternion is composed from the
+	# half-angles directly instead of going through a matrix. The half-angle
+	# sines are taken as sin / (2 cos(angle/2)) rather than from
+	# sqrt(1 - cos), which loses precision near zero roll and pitch.
+	n = sqrt(acc_x*acc_x + acc_y*acc_y + acc_z*acc_z)
+	a = acc_x / n
+	b = acc_y / n
+	c = acc_z / n
+	s_xz = sqrt(a*a + c*c)
+
+	# Roll: cos = s_xz >= 0, sin = -b. s_xz can round to just above 1
+	cr = sqrt(0.5*(1.0 + min(s_xz, 1.0)))
+	sr = -b / (2.0*cr)
+
+	# Pitch: cos = c / s_xz, sin = a / s_xz
+	if s_xz > 1e-9:
+		cos_pitch = min(max(c / s_xz, -1.0), 1.0)
+		sin_pitch = a / s_xz
+	else:
+		# zb_des is along yc, the pitch is undefined so keep it at zero
+		cos_pitch = 1.0
+		sin_pitch = 0.0
+	if cos_pitch >= 0.0:
+		cp = sqrt(0.5*(1.0 + cos_pitch))
+		sp = sin_pitch / (2.0*cp)
+	else:
+		sp = copysign(sqrt(0.5*(1.0 - cos_pitch)), sin_pitch)
+		cp = sin_pitch / (2.0*sp)
+
+	return (cp*cr, cp*sr, sp*cr, -sp*sr)
+
+@njit(cache=True)
+def _acc2quat_rows(desired_acc, out):
+	# _acc2quat applied to every row of an (N, 3) array, written to out (N, 4)
+	for i in range(desired_acc.shape[0]):
+		q = _acc2quat(float(desired_acc[i, 0]), float(desired_acc[i, 1]), float(desired_acc[i, 2]))
+		out[i, 0] = q[0]
+		out[i, 1] = q[1]
+		out[i, 2] = q[2]
+		out[i, 3] = q[3]
+	return out
+
+@njit(cache=True, fastmath=True)
+def _step_kernel(state, thrust, wx, wy, wz, g, mass, dt):
+	# Integrates state = [pos, att, vel] in place over one step of dt and
+	# returns the squared norms of the new position and velocity
+	# att is kept at unit norm by reset() and by the renormalisation below
+	qw = state[3]
+	qx = state[4]
+	qy = state[5]
+	qz = state[6]
+
+	# Body z-axis: third column of the rotation matrix of att
+	rz0 = 2.0*(qx*qz + qw*qy)
+	rz1 = 2.0*(qy*qz - qw*qx)
+	rz2 = 1.0 - 2.0*(qx*qx + qy*qy)
+	acc0 = thrust/mass * rz0 + g[0]
+	acc1 = thrust/mass * rz1 + g[1]
+	acc2 = thrust/mass * rz2 + g[2]
+
+	state[0] += state[7]*dt + 0.5*acc0*dt*dt
+	state[1] += state[8]*dt + 0.5*acc1*dt*dt
+	state[2] += state[9]*dt + 0.5*acc2*dt*dt
+	state[7] += acc0*dt
+	state[8] += acc1*dt
+	state[9] += acc2*dt
+
+	q_dot = _qdot((qw, qx, qy, qz), (wx, wy, wz))
+	state[3] += q_dot[0] * dt
+	state[4] += q_dot[1] * dt
+	state[5] += q_dot[2] * dt
+	state[6] += q_dot[3] * dt
+
+	# Project att back onto the unit sphere to stop forward Euler drift
+	inv_n = 1.0 / sqrt(state[3]*state[3] + state[4]*state[4] + state[5]*state[5] + state[6]*state[6])
+	state[3] *= inv_n
+	state[4] *= inv_n
+	state[5] *= inv_n
+	state[6] *= inv_n
+
+	pos_norm_sq = state[0]*state[0] + state[1]*state[1] + state[2]*state[2]
+	vel_norm_sq = state[7]*state[7] + state[8]*state[8] + state[9]*state[9]
+	return pos_norm_sq, vel_norm_sq
 
 class Quadrotor3D(gym.Env):
 	metadata = {'render.modes': ['human']}
 	def __init__(self):
 		self.mass = 1.0
 		self.dt = 0.01
-		self.g = np.array([0.0, 0.0, -9.8])
+		self.g = np.array([0.0, 0.0, -9.8], dtype=np.float32)
 
 		self.state = None
+		self._state_buf = np.empty(10, dtype=np.float32)
 
-		self.ref_pos = np.array([0.0, 0.0, 2.0])
-		self.ref_vel = np.array([0.0, 0.0, 0.0])
+		self.ref_pos = np.array([0.0, 0.0, 2.0], dtype=np.float32)
+		self.ref_vel = np.array([0.0, 0.0, 0.0], dtype=np.float32)
 
 		# Conditions to fail the episode
 		self.pos_threshold = 3.0
 		self.vel_threshold = 10.0
+		self._pos_thresh_sq = self.pos_threshold**2
+		self._vel_thresh_sq = self.vel_threshold**2
+
+		# Gains of the reference controller in control()
+		self._Kp = np.array([-5.0, -5.0, -5.0], dtype=np.float32)
+		self._Kv = np.array([-4.0, -4.0, -4.0], dtype=np.float32)
+		self._tau = 0.3
+		self._two_over_tau = 2.0/self._tau
+		self._reference_acc = np.zeros(3, dtype=np.float32)
 
 		self.viewer = None
 		self.render_quad1 = None
@@ -64,11 +183,18 @@ class Quadrotor3D(gym.Env):
 		self.render_rotor4 = None
 		self.render_velocity = None
 		self.render_ref = None
+		self.render_fps = 30.0
+		self._render_last_t = 0.0
 		self.x_range = 1.0
 		self.steps_beyond_done = None
 
-		self.action_space = spaces.Box(low=0.0, high=10.0, dtype=np.float, shape=(4,))
-		self.observation_space = spaces.Box(low=-10.0, high=10.0, dtype=np.float, shape=(10,))
+		self.action_space = spaces.Box(low=0.0, high=10.0, dtype=np.float32, shape=(4,))
+		self.observation_space = spaces.Box(low=-10.0, high=10.0, dtype=np.float32, shape=(10,))
+
+		# Compile the step kernel now rather than on the first step
+		warmup_state = np.zeros(10, dtype=np.float32)
+		warmup_state[3] = 1.0
+		_step_kernel(warmup_state, 0.0, 0.0, 0.0, 0.0, self.g, self.mass, self.dt)
 		
 		self.seed()
 		self.reset()
@@ -79,110 +205,80 @@ class Quadrotor3D(gym.Env):
 		return [seed]
 
 	def step(self, action):
-		thrust = action[0] # Thrust command
-		w = action[1:4] # Angular velocity command
-
-		state = self.state
-		ref_pos = self.ref_pos
-		ref_vel = self.ref_vel
-
-		pos = np.array([state[0], state[1], state[2]]).flatten()
-		att = np.array([state[3], state[4], state[5], state[6]]).flatten()
-		vel = np.array([state[7], state[8], state[9]]).flatten()
-
-
-		att_quaternion = Quaternion(att)
-
-		acc = thrust/self.mass * att_quaternion.rotation_matrix.dot(np.array([0.0, 0.0, 1.0])) + self.g
-		
-		pos = pos + vel * self.dt + 0.5*acc*self.dt*self.dt
-		vel = vel + acc * self.dt
-		
-		q_dot = att_quaternion.derivative(w)
-		att = att + q_dot.elements * self.dt
+		thrust, wx, wy, wz = action # Thrust and angular velocity command
 
-		self.state = (pos[0], pos[1], pos[2], att[0], att[1], att[2], att[3], vel[0], vel[1], vel[2])
+		# Python floats so every action dtype hits the warmed-up specialisation
+		pos_norm_sq, vel_norm_sq = _step_kernel(self.state, float(thrust), float(wx), float(wy), float(wz), self.g, self.mass, self.dt)
 
-		done =  linalg.norm(pos, 2) < -self.pos_threshold \
-			or  linalg.norm(pos, 2) > self.pos_threshold \
-			or linalg.norm(vel, 2) < -self.vel_threshold \
-			or linalg.norm(vel, 2) > self.vel_threshold
+		done = pos_norm_sq > self._pos_thresh_sq \
+			or vel_norm_sq > self._vel_thresh_sq
 		done = bool(done)
 
 		if not done:
-		    reward = (-linalg.norm(pos, 2))
+		    reward = -sqrt(pos_norm_sq)
 		elif self.steps_beyond_done is None:
 		    # Pole just fell!
 		    self.steps_beyond_done = 0
 		    reward = 1.0
 		else:
 		    if self.steps_beyond_done == 0:
-			    logger.warn("You are calling 'step()' even though this environment has already returned done = True. You should always call 'reset()' once you receive 'done = True' -- any further steps are undefined behavior.")
+			    logger.warn(_STEP_AFTER_DONE_MSG)
 		    self.steps_beyond_done += 1
 		    reward = 0.0
 
-		return np.array(self.state), reward, done, {}
+		return self.state.copy(), reward, done, {}
 
 	def control(self):
-		def acc2quat(desired_acc, yaw): # TODO: Yaw rotation
-			zb_des = desired_acc / linalg.norm(desired_acc)
-			yc = np.array([0.0, 1.0, 0.0])
-			xb_des = np.cross(yc, zb_des)
-			xb_des = xb_des / linalg.norm(xb_des)
-			yb_des = np.cross(zb_des, xb_des)
-			zb_des = zb_des / linalg.norm(zb_des)
-
-			rotmat = np.array([[xb_des[0], yb_des[0], zb_des[0]],
-							   [xb_des[1], yb_des[1], zb_des[1]],
-							   [xb_des[2], yb_des[2], zb_des[2]]])
-
-			desired_att = Quaternion(matrix=rotmat)
-
-			return desired_att
-
-		Kp = np.array([-5.0, -5.0, -5.0])
-		Kv = np.array([-4.0, -4.0, -4.0])
-		tau = 0.3
-
 		state = self.state
 		ref_pos = self.ref_pos
 		ref_vel = self.ref_vel
 
-		pos = np.array([state[0], state[1], state[2]]).flatten()
-		att = np.array([state[3], state[4], state[5], state[6]]).flatten()
-		vel = np.array([state[7], state[8], state[9]]).flatten()
+		pos = state[0:3]
+		att = state[3:7]
+		vel = state[7:10]
 
 		error_pos = pos - ref_pos
 		error_vel = vel - ref_vel
 
 		# %% Calculate desired acceleration
-		reference_acc = np.array([0.0, 0.0, 0.0])
-		feedback_acc = Kp * error_pos + Kv * error_vel 
+		feedback_acc = self._Kp * error_pos + self._Kv * error_vel 
 
-		desired_acc = reference_acc + feedback_acc - self.g
+		desired_acc = self._reference_acc + feedback_acc - self.g
 
-		desired_att = acc2quat(desired_acc, 0.0)
+		desired_att = _acc2quat(float(desired_acc[0]), float(desired_acc[1]), float(desired_acc[2]))
 
-		desired_quat = Quaternion(desired_att)
-		current_quat = Quaternion(att)
-
-		error_att = current_quat.conjugate * desired_quat
-		qe = error_att.elements
+		# Attitude error: qe = conj(att) x desired_att, att is a unit
+		# quaternion so its inverse is the conjugate
+		aw, ax, ay, az = att
+		qe = np.array(_qmul((aw, -ax, -ay, -az), desired_att))
 
 		
-		w = (2/tau) * np.sign(qe[0])*qe[1:4]
+		w = self._two_over_tau * np.sign(qe[0])*qe[1:4]
 
 		
-		thrust = desired_acc.dot(current_quat.rotation_matrix.dot(np.array([0.0, 0.0, 1.0])))
+		# Body z-axis: third column of the rotation matrix of att
+		thrust = desired_acc[0]*2.0*(ax*az + aw*ay) \
+			+ desired_acc[1]*2.0*(ay*az - aw*ax) \
+			+ desired_acc[2]*(1.0 - 2.0*(ax*ax + ay*ay))
 		
 		action = np.array([thrust, w[0], w[1], w[2]])
 
 		return action
 
 	def reset(self):
-		print("reset")
-		self.state = np.array(self.np_random.uniform(low=-1.0, high=1.0, size=(10,)))
-		return np.array(self.state)
+		self.state = self._state_buf
+		self.state[:] = self.np_random.uniform(low=-1.0, high=1.0, size=(10,))
+		self.state[3:7] /= linalg.norm(self.state[3:7])
+		self.steps_beyond_done = None
+		return self.state.copy()
+
+	def _body_axes(self):
+		# Body axes are the columns of the rotation matrix of att
+		qw, qx, qy, qz = self.state[3:7]
+		x_axis = (1.0 - 2.0*(qy*qy + qz*qz), 2.0*(qx*qy + qw*qz), 2.0*(qx*qz - qw*qy))
+		y_axis = (2.0*(qx*qy - qw*qz), 1.0 - 2.0*(qx*qx + qz*qz), 2.0*(qy*qz + qw*qx))
+		z_axis = (2.0*(qx*qz + qw*qy), 2.0*(qy*qz - qw*qx), 1.0 - 2.0*(qx*qx + qy*qy))
+		return x_axis, y_axis, z_axis
 
 	def render(self, mode='human', close=False):
 		from vpython import box, sphere, color, vector, rate, canvas, cylinder, arrow, curve
@@ -205,17 +301,11 @@ class Quadrotor3D(gym.Env):
 		ref_pos = self.ref_pos
 		ref_vel = self.ref_vel
 
-		pos = np.array([state[0], state[1], state[2]]).flatten()
-		att = np.array([state[3], state[4], state[5], state[6]]).flatten()
-		vel = np.array([state[7], state[8], state[9]]).flatten()
-
-
-		current_quat = Quaternion(att)
-		x_axis = current_quat.rotation_matrix.dot(np.array([1.0, 0.0, 0.0]))
-		y_axis = current_quat.rotation_matrix.dot(np.array([0.0, 1.0, 0.0]))
-		z_axis = current_quat.rotation_matrix.dot(np.array([0.0, 0.0, 1.0]))
+		pos = state[0:3]
+		vel = state[7:10]
 
 		if self.viewer is None:
+			x_axis, y_axis, z_axis = self._body_axes()
 			self.viewer = canvas(title='Quadrotor 3D', width=640, height=480, center=vector(0, 0, 2), forward=vector(1, 1, -0.5), up=vector(0, 0, 1), background=color.white, range=4.0, autoscale = False)
 			self.render_quad1 = box(canvas = self.viewer, pos=vector(pos[0],pos[1],0), axis=vector(x_axis[0],x_axis[1],x_axis[2]), length=0.2, height=0.05, width=0.05)
 			self.render_quad2 = box(canvas = self.viewer, pos=vector(pos[0],pos[1],0), axis=vector(y_axis[0],y_axis[1],y_axis[2]), length=0.2, height=0.05, width=0.05)
@@ -223,84 +313,43 @@ class Quadrotor3D(gym.Env):
 			self.render_rotor2 = cylinder(canvas = self.viewer, pos=vector(pos[0],pos[1],0), axis=vector(0.01*z_axis[0],0.01*z_axis[1],0.01*z_axis[2]), radius=0.2, color=color.cyan, opacity=0.5)
 			self.render_rotor3 = cylinder(canvas = self.viewer, pos=vector(pos[0],pos[1],0), axis=vector(0.01*z_axis[0],0.01*z_axis[1],0.01*z_axis[2]), radius=0.2, color=color.cyan, opacity=0.5)
 			self.render_rotor4 = cylinder(canvas = self.viewer, pos=vector(pos[0],pos[1],0), axis=vector(0.01*z_axis[0],0.01*z_axis[1],0.01*z_axis[2]), radius=0.2, color=color.cyan, opacity=0.5)
-			self.render_velocity = pointer = arrow(pos=vector(pos[0],pos[1],0), axis=vector(vel[0],vel[1],vel[2]), shaftwidth=0.05, color=color.green)
+			self.render_velocity = arrow(pos=vector(pos[0],pos[1],0), axis=vector(vel[0],vel[1],vel[2]), shaftwidth=0.05, color=color.green)
 			self.render_ref = sphere(canvas = self.viewer, pos=vector(ref_pos[0], ref_pos[1], ref_pos[2]), radius=0.02, color=color.blue, make_trail = True)
 			grid_xy = make_grid(5, 100)
 		if self.state is None: return None
 
-		self.render_quad1.pos.x = pos[0]
-		self.render_quad1.pos.y = pos[1]
-		self.render_quad1.pos.z = pos[2]
-		self.render_quad2.pos.x = pos[0]
-		self.render_quad2.pos.y = pos[1]
-		self.render_quad2.pos.z = pos[2]
-		rotor_pos = 0.5*x_axis
-		self.render_rotor1.pos.x = pos[0] + rotor_pos[0]
-		self.render_rotor1.pos.y = pos[1] + rotor_pos[1]
-		self.render_rotor1.pos.z = pos[2] + rotor_pos[2]
-		rotor_pos = (-0.5)*x_axis
-		self.render_rotor2.pos.x = pos[0] + rotor_pos[0]
-		self.render_rotor2.pos.y = pos[1] + rotor_pos[1]
-		self.render_rotor2.pos.z = pos[2] + rotor_pos[2]
-		rotor_pos = 0.5*y_axis
-		self.render_rotor3.pos.x = pos[0] + rotor_pos[0]
-		self.render_rotor3.pos.y = pos[1] + rotor_pos[1]
-		self.render_rotor3.pos.z = pos[2] + rotor_pos[2]
-		rotor_pos = (-0.5)*y_axis
-		self.render_rotor4.pos.x = pos[0] + rotor_pos[0]
-		self.render_rotor4.pos.y = pos[1] + rotor_pos[1]
-		self.render_rotor4.pos.z = pos[2] + rotor_pos[2]
-		self.render_velocity.pos.x = pos[0]
-		self.render_velocity.pos.y = pos[1]
-		self.render_velocity.pos.z = pos[2]
-
-		self.render_quad1.axis.x = x_axis[0]
-		self.render_quad1.axis.y = x_axis[1]	
-		self.render_quad1.axis.z = x_axis[2]
-		self.render_quad2.axis.x = y_axis[0]
-		self.render_quad2.axis.y = y_axis[1]
-		self.render_quad2.axis.z = y_axis[2]
-		self.render_rotor1.axis.x = 0.01*z_axis[0]
-		self.render_rotor1.axis.y = 0.01*z_axis[1]
-		self.render_rotor1.axis.z = 0.01*z_axis[2]
-		self.render_rotor2.axis.x = 0.01*z_axis[0]
-		self.render_rotor2.axis.y = 0.01*z_axis[1]
-		self.render_rotor2.axis.z = 0.01*z_axis[2]
-		self.render_rotor3.axis.x = 0.01*z_axis[0]
-		self.render_rotor3.axis.y = 0.01*z_axis[1]
-		self.render_rotor3.axis.z = 0.01*z_axis[2]
-		self.render_rotor4.axis.x = 0.01*z_axis[0]
-		self.render_rotor4.axis.y = 0.01*z_axis[1]
-		self.render_rotor4.axis.z = 0.01*z_axis[2]
-		self.render_velocity.axis.x = 0.5 * vel[0]
-		self.render_velocity.axis.y = 0.5 * vel[1]
-		self.render_velocity.axis.z = 0.5 * vel[2]
-
-
-		self.render_quad1.up.x = z_axis[0]
-		self.render_quad1.up.y = z_axis[1]
-		self.render_quad1.up.z = z_axis[2]
-		self.render_quad2.up.x = z_axis[0]
-		self.render_quad2.up.y = z_axis[1]
-		self.render_quad2.up.z = z_axis[2]
-		self.render_rotor1.up.x = y_axis[0]
-		self.render_rotor1.up.y = y_axis[1]
-		self.render_rotor1.up.z = y_axis[2]
-		self.render_rotor2.up.x = y_axis[0]
-		self.render_rotor2.up.y = y_axis[1]
-		self.render_rotor2.up.z = y_axis[2]
-		self.render_rotor3.up.x = y_axis[0]
-		self.render_rotor3.up.y = y_axis[1]
-		self.render_rotor3.up.z = y_axis[2]
-		self.render_rotor4.up.x = y_axis[0]
-		self.render_rotor4.up.y = y_axis[1]
-		self.render_rotor4.up.z = y_axis[2]
-
-
-
-		self.render_ref.pos.x = ref_pos[0]
-		self.render_ref.pos.y = ref_pos[1]
-		self.render_ref.pos.z = ref_pos[2]
+		# Only push a new frame to the viewer at render_fps
+		now = timer()
+		if now - self._render_last_t < 1.0/self.render_fps:
+			rate(100)
+			return True
+		self._render_last_t = now
+
+		x_axis, y_axis, z_axis = self._body_axes()
+		p = vector(pos[0], pos[1], pos[2])
+		x_ax = vector(x_axis[0], x_axis[1], x_axis[2])
+		y_ax = vector(y_axis[0], y_axis[1], y_axis[2])
+		z_ax = vector(z_axis[0], z_axis[1], z_axis[2])
+		rotor_axis = 0.01*z_ax
+
+		self.render_quad1.pos = p
+		self.render_quad1.axis = x_ax
+		self.render_quad1.up = z_ax
+		self.render_quad2.pos = p
+		self.render_quad2.axis = y_ax
+		self.render_quad2.up = z_ax
+
+		rotor_offsets = (0.5*x_ax, -0.5*x_ax, 0.5*y_ax, -0.5*y_ax)
+		rotors = (self.render_rotor1, self.render_rotor2, self.render_rotor3, self.render_rotor4)
+		for rotor, offset in zip(rotors, rotor_offsets):
+			rotor.pos = p + offset
+			rotor.axis = rotor_axis
+			rotor.up = y_ax
+
+		self.render_velocity.pos = p
+		self.render_velocity.axis = vector(0.5*vel[0], 0.5*vel[1], 0.5*vel[2])
+
+		self.render_ref.pos = vector(ref_pos[0], ref_pos[1], ref_pos[2])
 
 		rate(100)
 
@@ -0,0 +1,165 @@
+# **********************************************************************
+#
+# Copyright (c) 2019, Autonomous Systems Lab
+# Author: Jaeyoung Lim <jalim@student.ethz.ch>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in
+#    the documentation and/or other materials provided with the
+#    distribution.
+# 3. Neither the name PX4 nor the names of its contributors may be
+#    used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS
+# OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED
+# AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# *************************************************************************
+import gym
+from gym import spaces
+import numpy as np
+from gym.utils import seeding
+from gym_reinmav.envs.native.quadrotor3d import _acc2quat_rows
+
+class Quadrotor3DBatch(gym.Env):
+	# Runs num_envs independent Quadrotor3D environments in lock step. The
+	# state of all of them is one (num_envs, 10) array [pos, att, vel] and
+	# every operation is vectorised over the leading axis.
+	# Environments that are done at the end of step() are reset in place,
+	# their terminal states are returned in info['terminal_states'].
+	metadata = {'render.modes': []}
+	def __init__(self, num_envs=16):
+		self.num_envs = num_envs
+		self.mass = 1.0
+		self.dt = 0.01
+		self.g = np.array([0.0, 0.0, -9.8], dtype=np.float32)
+
+		self.states = np.empty((num_envs, 10), dtype=np.float32)
+		self.pos = self.states[:, 0:3]
+		self.att = self.states[:, 3:7]
+		self.vel = self.states[:, 7:10]
+
+		self.refs = np.tile(np.array([0.0, 0.0, 2.0], dtype=np.float32), (num_envs, 1))
+		self.ref_vels = np.zeros((num_envs, 3), dtype=np.float32)
+
+		# Conditions to fail the episode
+		self.pos_threshold = 3.0
+		self.vel_threshold = 10.0
+		self._pos_thresh_sq = self.pos_threshold**2
+		self._vel_thresh_sq = self.vel_threshold**2
+
+		# Gains of the reference controller in control()
+		self._Kp = np.array([-5.0, -5.0, -5.0], dtype=np.float32)
+		self._Kv = np.array([-4.0, -4.0, -4.0], dtype=np.float32)
+		self._tau = 0.3
+		self._two_over_tau = 2.0/self._tau
+
+		# Work buffers reused by every step()
+		self._rz = np.empty((num_envs, 3), dtype=np.float32)
+		self._acc = np.empty((num_envs, 3), dtype=np.float32)
+		self._q_dot = np.empty((num_envs, 4), dtype=np.float32)
+		self._desired_att = np.empty((num_envs, 4))
+
+		self.action_space = spaces.Box(low=0.0, high=10.0, dtype=np.float32, shape=(num_envs, 4))
+		self.observation_space = spaces.Box(low=-10.0, high=10.0, dtype=np.float32, shape=(num_envs, 10))
+
+		self.seed()
+		self.reset()
+
+	def seed(self, seed=None):
+		self.np_random, seed = seeding.np_random(seed)
+		return [seed]
+
+	def _body_z(self):
+		# Third column of the rotation matrix of every att
+		qw, qx, qy, qz = self.att.T
+		rz = self._rz
+		rz[:, 0] = 2.0*(qx*qz + qw*qy)
+		rz[:, 1] = 2.0*(qy*qz - qw*qx)
+		rz[:, 2] = 1.0 - 2.0*(qx*qx + qy*qy)
+		return rz
+
+	def step(self, actions):
+		thrust = actions[:, 0] # Thrust commands
+		wx, wy, wz = actions[:, 1:4].T # Angular velocity commands
+
+		pos, att, vel = self.pos, self.att, self.vel
+
+		acc = self._acc
+		np.multiply((thrust/self.mass)[:, None], self._body_z(), out=acc)
+		acc += self.g
+
+		pos += vel*self.dt + 0.5*acc*self.dt*self.dt
+		vel += acc*self.dt
+
+		# Quaternion kinematics: q_dot = 0.5 * q x (0, w)
+		qw, qx, qy, qz = att.T
+		q_dot = self._q_dot
+		q_dot[:, 0] = -0.5*(qx*wx + qy*wy + qz*wz)
+		q_dot[:, 1] = 0.5*(qw*wx + qy*wz - qz*wy)
+		q_dot[:, 2] = 0.5*(qw*wy - qx*wz + qz*wx)
+		q_dot[:, 3] = 0.5*(qw*wz + qx*wy - qy*wx)
+		att += q_dot*self.dt
+		att /= np.sqrt(np.einsum('ij,ij->i', att, att))[:, None]
+
+		pos_norm_sq = np.einsum('ij,ij->i', pos, pos)
+		vel_norm_sq = np.einsum('ij,ij->i', vel, vel)
+		dones = (pos_norm_sq > self._pos_thresh_sq) | (vel_norm_sq > self._vel_thresh_sq)
+		rewards = np.where(dones, 1.0, -np.sqrt(pos_norm_sq))
+
+		# Keep the final states of finished environments before they are reset
+		info = {'terminal_states': self.states[dones]}
+		if dones.any():
+			self._reset_envs(dones)
+
+		return self.states.copy(), rewards, dones, info
+
+	def control(self):
+		pos, att, vel = self.pos, self.att, self.vel
+
+		error_pos = pos - self.refs
+		error_vel = vel - self.ref_vels
+
+		# %% Calculate desired acceleration
+		desired_acc = self._Kp * error_pos + self._Kv * error_vel - self.g
+
+		dw, dx, dy, dz = _acc2quat_rows(desired_acc, self._desired_att).T
+
+		# Attitude error: qe = conj(att) x desired_att
+		aw, ax, ay, az = att.T
+		qe0 = aw*dw + ax*dx + ay*dy + az*dz
+		gain = self._two_over_tau * np.sign(qe0)
+
+		actions = np.empty((self.num_envs, 4))
+		actions[:, 0] = np.einsum('ij,ij->i', desired_acc, self._body_z())
+		actions[:, 1] = gain * (aw*dx - ax*dw - ay*dz + az*dy)
+		actions[:, 2] = gain * (aw*dy + ax*dz - ay*dw - az*dx)
+		actions[:, 3] = gain * (aw*dz - ax*dy + ay*dx - az*dw)
+
+		return actions
+
+	def _reset_envs(self, mask):
+		n = int(np.count_nonzero(mask))
+		new_states = self.np_random.uniform(low=-1.0, high=1.0, size=(n, 10))
+		new_states[:, 3:7] /= np.linalg.norm(new_states[:, 3:7], axis=1)[:, None]
+		self.states[mask] = new_states
+
+	def reset(self):
+		self._reset_envs(np.ones(self.num_envs, dtype=bool))
+		return self.states.copy()
@@ -18,6 +18,7 @@ setup(name='gym_reinmav',
           'vpython',
           'pyquaternion',
           'matplotlib',
+          'numba',
       ],
       extras_require=extras,
       )
@@ -3,6 +3,7 @@ import unittest
 
 # 3rd party modules
 import gym
+import numpy as np
 
 # internal modules
 import gym_reinmav
@@ -13,7 +14,7 @@ class Environments(unittest.TestCase):
 		env = gym.make('quadrotor3d-v0')
 		env.reset()
 		start_t=timer()
-		for i,_ in enumerate(range(400)): #dt=0.01, 400*0.01=4s
+		for _ in range(400): #dt=0.01, 400*0.01=4s
 
 			action = env.control()
 			_, reward, done, _ = env.step(action) # take a random action
@@ -23,6 +24,18 @@ class Environments(unittest.TestCase):
 		end_t=timer()
 		print("simulation time=",end_t-start_t)
 		# env.plot_state()
+
+	def test_control_planar_state(self):
+		# Without y motion the xz norm in acc2quat can round to just above 1
+		env = gym.make('quadrotor3d-v0').unwrapped
+		planar_states = [[-0.399, 0.0, 0.862, 1.0, 0.0, 0.0, 0.0, -0.997, 0.0, -0.364],
+						 [-0.92, 0.0, -0.183, 1.0, 0.0, 0.0, 0.0, -0.296, 0.0, 0.54],
+						 [-0.765, 0.0, 0.633, 1.0, 0.0, 0.0, 0.0, 0.789, 0.0, 0.009],
+						 [-0.578, 0.0, 0.098, 1.0, 0.0, 0.0, 0.0, 0.307, 0.0, 0.414]]
+		for state in planar_states:
+			env.state[:] = state
+			action = env.control()
+			self.assertTrue(np.all(np.isfinite(action)))
 if __name__ == "__main__":
 	env=Environments()
 	env.test_env()
\ No newline at end of file
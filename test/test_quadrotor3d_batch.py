@@ -0,0 +1,65 @@
+# core modules
+import unittest
+
+# 3rd party modules
+import gym
+import numpy as np
+
+# internal modules
+import gym_reinmav
+from timeit import default_timer as timer
+
+class Environments(unittest.TestCase):
+	def test_env(self):
+		env = gym.make('quadrotor3d-batch-v0', num_envs=64)
+		env.reset()
+		start_t=timer()
+		for _ in range(400): #dt=0.01, 400*0.01=4s
+
+			actions = env.control()
+			self.assertTrue(np.all(np.isfinite(actions)))
+			states, rewards, dones, _ = env.step(actions) # done envs are reset by step()
+			self.assertEqual(states.shape, (64, 10))
+			self.assertEqual(rewards.shape, (64,))
+		end_t=timer()
+		print("simulation time=",end_t-start_t)
+
+	def test_matches_single_env(self):
+		num_envs = 8
+		batch = gym.make('quadrotor3d-batch-v0', num_envs=num_envs).unwrapped
+		singles = [gym.make('quadrotor3d-v0').unwrapped for _ in range(num_envs)]
+		# Planar states used to produce NaN actions in control()
+		batch.states[:4] = [[-0.399, 0.0, 0.862, 1.0, 0.0, 0.0, 0.0, -0.997, 0.0, -0.364],
+							[-0.92, 0.0, -0.183, 1.0, 0.0, 0.0, 0.0, -0.296, 0.0, 0.54],
+							[-0.765, 0.0, 0.633, 1.0, 0.0, 0.0, 0.0, 0.789, 0.0, 0.009],
+							[-0.578, 0.0, 0.098, 1.0, 0.0, 0.0, 0.0, 0.307, 0.0, 0.414]]
+		# Leaves the position bounds within a few steps
+		batch.states[4] = [2.95, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 3.0, 0.0, 0.0]
+		for env, state in zip(singles, batch.states):
+			env.state[:] = state
+
+		num_done = 0
+		for _ in range(20):
+			actions = batch.control()
+			self.assertTrue(np.all(np.isfinite(actions)))
+			single_actions = np.array([env.control() for env in singles])
+			np.testing.assert_allclose(actions, single_actions, rtol=1e-4, atol=1e-4)
+
+			states, rewards, dones, info = batch.step(actions)
+			terminal_states = iter(info['terminal_states'])
+			for i, env in enumerate(singles):
+				single_state, single_reward, single_done, _ = env.step(actions[i])
+				self.assertEqual(dones[i], single_done)
+				if single_done:
+					num_done += 1
+					# The batch env has already reset this one
+					np.testing.assert_allclose(next(terminal_states), single_state, rtol=1e-4, atol=1e-4)
+					env.reset()
+					env.state[:] = states[i]
+				else:
+					np.testing.assert_allclose(states[i], single_state, rtol=1e-4, atol=1e-4)
+					self.assertAlmostEqual(rewards[i], single_reward, places=4)
+		self.assertGreater(num_done, 0)
+if __name__ == "__main__":
+	env=Environments()
+	env.test_env()
\ No newline at end of file